@@ -1,24 +1,47 @@
 import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 
 import numpy as np
 import pandas as pd
+from numba import njit
 
 here = os.path.dirname(os.path.realpath(__file__))
 sys.path.append(os.path.join(here, "../.."))
 sys.path.append(os.path.join(here, ".."))
 
-from config import FEATURE_TABLE_INFO
+from config import FEATURE_TABLE_INFO, NBA_IMPORTANT_DATES
 from utils.general_utils import find_season_information
 
 
+@njit(cache=True)
+def _running_streaks(performance, group_starts, streaks):
+    # Streak going into each game, reset at the start of every group
+    for group in range(len(group_starts) - 1):
+        current_streak = 0
+        for i in range(group_starts[group], group_starts[group + 1]):
+            streaks[i] = current_streak
+
+            result = performance[i]
+            if result == 0:  # If game is in progress, skip updating the streak
+                continue
+
+            if current_streak == 0:
+                current_streak = result
+            elif np.sign(current_streak) == np.sign(result):
+                current_streak += result
+            else:
+                current_streak = result
+
+
 class FeatureCreationPreMerge:
     def __init__(self, features_tables):
         self.features_tables = features_tables
         self.updated_features_tables = features_tables.copy()
 
     def full_feature_creation(self):
+        feature_methods = {}
         for table_name in self.features_tables:
             try:
                 method = getattr(self, f"_create_features_{table_name}")
@@ -26,65 +49,87 @@ class FeatureCreationPreMerge:
                 print(f"No feature creation method for table: {table_name}")
                 continue
             else:
+                feature_methods[table_name] = method
+
+        if not feature_methods:
+            return self.updated_features_tables
+
+        # With a single table or CPU a worker process only adds overhead
+        max_workers = min(len(feature_methods), os.cpu_count() or 1)
+        if max_workers == 1:
+            for table_name, method in feature_methods.items():
                 self.updated_features_tables[table_name] = method(
                     self.features_tables[table_name]
                 )
+            return self.updated_features_tables
+
+        # The tables are independent, so their features are created in parallel
+        # processes. The feature creation methods are static so only the table
+        # itself is sent to the worker process.
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                table_name: executor.submit(method, self.features_tables[table_name])
+                for table_name, method in feature_methods.items()
+            }
+            for table_name, future in futures.items():
+                self.updated_features_tables[table_name] = future.result()
         return self.updated_features_tables
 
     # FEATURE CREATION METHODS
-    def _create_features_team_nbastats_general_traditional(self, df):
+    @staticmethod
+    def _create_features_team_nbastats_general_traditional(df):
         table_info = FEATURE_TABLE_INFO["team_nbastats_general_traditional"]
-        return self._zscore_and_percentiles(
+        return FeatureCreationPreMerge._zscore_and_percentiles(
             df, table_info["feature_columns"], table_info["date_column"]
         )
 
-    def _create_features_team_nbastats_general_advanced(self, df):
+    @staticmethod
+    def _create_features_team_nbastats_general_advanced(df):
         table_info = FEATURE_TABLE_INFO["team_nbastats_general_advanced"]
-        return self._zscore_and_percentiles(
+        return FeatureCreationPreMerge._zscore_and_percentiles(
             df, table_info["feature_columns"], table_info["date_column"]
         )
 
-    def _create_features_team_nbastats_general_fourfactors(self, df):
+    @staticmethod
+    def _create_features_team_nbastats_general_fourfactors(df):
         table_info = FEATURE_TABLE_INFO["team_nbastats_general_fourfactors"]
-        return self._zscore_and_percentiles(
+        return FeatureCreationPreMerge._zscore_and_percentiles(
             df, table_info["feature_columns"], table_info["date_column"]
         )
 
-    def _create_features_team_nbastats_general_opponent(self, df):
+    @staticmethod
+    def _create_features_team_nbastats_general_opponent(df):
         table_info = FEATURE_TABLE_INFO["team_nbastats_general_opponent"]
-        return self._zscore_and_percentiles(
+        return FeatureCreationPreMerge._zscore_and_percentiles(
             df, table_info["feature_columns"], table_info["date_column"]
         )
 
     # HELPER METHODS
 
-    def _zscore_and_percentiles(self, df, all_feature_cols, date_col):
-        def safe_zscore(s, ddof=1):
-            mean = s.mean()
-            std = s.std(ddof=ddof)
-            if std == 0:
-                return pd.Series([np.nan] * len(s), index=s.index)
-            return (s - mean) / std
-
-        def safe_percentile(s):
-            return s.rank(pct=True)
-
-        for col in all_feature_cols:
-            df[col + "_zscore"] = (
-                df.groupby(date_col)[col].transform(safe_zscore).where(df[col].notnull())
-            )
-            df[col + "_percentile"] = (
-                df.groupby(date_col)[col]
-                .transform(safe_percentile)
-                .where(df[col].notnull())
-            )
+    @staticmethod
+    def _zscore_and_percentiles(df, all_feature_cols, date_col):
+        # Group once and run the built-in grouped kernels over all feature columns
+        feature_cols = list(all_feature_cols)
+        grouped = df.groupby(date_col, sort=False)[feature_cols]
+        mean = grouped.transform("mean")
+        # A date with no variation has no meaningful zscore
+        std = grouped.transform("std").replace(0, np.nan)
+
+        has_value = df[feature_cols].notnull()
+        zscores = ((df[feature_cols] - mean) / std).where(has_value)
+        percentiles = grouped.rank(pct=True).where(has_value)
+
+        for col in feature_cols:
+            df[col + "_zscore"] = zscores[col]
+            df[col + "_percentile"] = percentiles[col]
 
         return df
 
 
 class FeatureCreationPostMerge:
     def __init__(self, combined_features):
-        self.updated_combined_features = combined_features.copy()
+        # New feature columns are added to the combined features in place
+        self.updated_combined_features = combined_features
 
     def full_feature_creation(self):
         self.updated_combined_features = self._add_season_timeframe_info(
@@ -93,253 +138,179 @@ class FeatureCreationPostMerge:
         self.updated_combined_features = self._add_day_of_season(
             self.updated_combined_features
         )
+
+        # The team level steps share one row per team per game, built once
+        self.updated_combined_features = self.updated_combined_features.sort_values(
+            ["season", "game_datetime"]
+        )
+        team_games_df = self._create_team_games(self.updated_combined_features)
         self.updated_combined_features = self._calculate_days_since_last_game(
-            self.updated_combined_features
+            self.updated_combined_features, team_games_df
         )
         self.updated_combined_features = self._calculate_team_performance_metrics(
-            self.updated_combined_features
+            self.updated_combined_features, team_games_df
         )
-        self.updated_combined_features = self._encode_home_team(
+        self.updated_combined_features = self._encode_teams(
             self.updated_combined_features
         )
-        self.updated_combined_features = self._encode_away_team(
-            self.updated_combined_features
-        )
-
-        self.updated_combined_features = self.updated_combined_features.drop(
-            columns=["reg_season_start_date"]
-        )
 
         return self.updated_combined_features
 
     def _add_season_timeframe_info(self, df):
-        # Convert the 'game_datetime' to a string format and apply 'find_season_information'
-        season_info_series = (
-            df["game_datetime"].dt.strftime("%Y-%m-%d").apply(find_season_information)
-        )
-
-        # Extract relevant info from the dictionaries and add as new columns
-        df["season"] = season_info_series.apply(lambda x: x["season"])
-        df["season_type"] = season_info_series.apply(lambda x: x["season_type"])
-        df["reg_season_start_date"] = season_info_series.apply(
-            lambda x: x["reg_season_start_date"]
-        )
-        df["reg_season_start_date"] = pd.to_datetime(df["reg_season_start_date"])
+        # Look up the season information once per unique game date
+        # instead of once per game
+        game_dates = df["game_datetime"].dt.normalize()
+        unique_dates = game_dates.unique()
+        season_info_df = pd.DataFrame(
+            [
+                find_season_information(date.strftime("%Y-%m-%d"))
+                for date in pd.DatetimeIndex(unique_dates)
+            ],
+            index=unique_dates,
+            columns=["season", "season_type"],
+        ).reindex(game_dates)
+
+        # Add the season info for each game as new columns
+        df["season"] = season_info_df["season"].to_numpy()
+        df["season_type"] = season_info_df["season_type"].to_numpy()
         return df
 
     def _add_day_of_season(self, df):
+        # The regular season start date only depends on the season
+        reg_season_start_dates = {
+            season: pd.Timestamp(NBA_IMPORTANT_DATES[season]["reg_season_start_date"])
+            for season in df["season"].unique()
+        }
         df["day_of_season"] = (
-            df["game_datetime"] - df["reg_season_start_date"]
+            df["game_datetime"] - df["season"].map(reg_season_start_dates)
         ).dt.days + 1
         return df
 
-    def _encode_home_team(self, df):
-        dummies = pd.get_dummies(df["home_team"], prefix="home")
-        df = pd.concat([df, dummies], axis=1)
-        return df
-
-    def _encode_away_team(self, df):
-        dummies = pd.get_dummies(df["away_team"], prefix="away")
-        df = pd.concat([df, dummies], axis=1)
+    def _encode_teams(self, df):
+        # Build both sets of dummies first so the frame is only rebuilt once
+        # One byte per flag regardless of the pandas default dummy dtype
+        home_dummies = pd.get_dummies(df["home_team"], prefix="home", dtype=np.uint8)
+        away_dummies = pd.get_dummies(df["away_team"], prefix="away", dtype=np.uint8)
+        df = pd.concat([df, home_dummies, away_dummies], axis=1, copy=False)
         return df
 
-    def _calculate_days_since_last_game(self, df):
-        # Create two copies of the dataframe, one for home games, one for away games
-        home_df = df[["game_datetime", "season", "home_team"]].rename(
-            columns={"home_team": "team"}
-        )
-        away_df = df[["game_datetime", "season", "away_team"]].rename(
-            columns={"away_team": "team"}
+    def _create_team_games(self, df):
+        # Reshape to one row per team per game so the team metrics can be computed
+        # with a single grouped pass instead of a loop over each season and team.
+        # The first half of the rows are the home teams, the second half the away teams,
+        # built straight from the column arrays without intermediate frames.
+        stack = self._stack_home_and_away
+        team_games_df = pd.DataFrame(
+            {
+                "season": pd.Categorical(stack(df, "season", "season")),
+                "game_datetime": stack(df, "game_datetime", "game_datetime"),
+                "game_completed": stack(df, "game_completed", "game_completed"),
+                "team": pd.Categorical(stack(df, "home_team", "away_team")),
+                "team_score": stack(df, "home_score", "away_score"),
+                "opponent_score": stack(df, "away_score", "home_score"),
+            }
         )
 
-        # Concatenate along the row axis (i.e., append the dataframes one below the other)
-        all_games_df = pd.concat([home_df, away_df], axis=0)
-
-        # Sort the dataframe by team and date
-        all_games_df.sort_values(["team", "game_datetime"], inplace=True)
-
-        # Initialize an empty list to store the intermediate dataframes
-        df_list = []
-
-        # Loop over each season
-        for season in all_games_df["season"].unique():
-            # Filter the dataframe for the current season
-            season_df = all_games_df[all_games_df["season"] == season].copy()
-
-            # Calculate the days since the last game for each team
-            season_df["days_since_last_game"] = (
-                season_df.groupby("team")["game_datetime"].diff().dt.days
-            )
-
-            # Append the results to the df_list
-            df_list.append(season_df)
-
-        # Concatenate all the intermediate dataframes in df_list into a single dataframe
-        df_result = pd.concat(df_list, axis=0)
+        # Season and team are categorical so the sort and the groupbys on them
+        # work on integer codes instead of hashing strings.
+        # Sort by season, team and date so each team's games are in order
+        team_games_df.sort_values(
+            ["season", "team", "game_datetime"], kind="mergesort", inplace=True
+        )
+        return team_games_df
 
-        # Merge the original dataframe with the result dataframe
-        df = pd.merge(
-            df,
-            df_result,
-            how="left",
-            left_on=["game_datetime", "season", "home_team"],
-            right_on=["game_datetime", "season", "team"],
+    def _calculate_days_since_last_game(self, df, team_games_df):
+        # Calculate the days since the last game for each team within each season
+        team_groups = team_games_df.groupby(
+            ["season", "team"], sort=False, observed=True
         )
-        df = pd.merge(
-            df,
-            df_result,
-            how="left",
-            left_on=["game_datetime", "season", "away_team"],
-            right_on=["game_datetime", "season", "team"],
-            suffixes=("_home", "_away"),
+        team_games_df["days_since_last_game"] = (
+            team_groups["game_datetime"].diff().dt.days
+        )
+
+        home_values, away_values = self._split_home_and_away(
+            team_games_df, "days_since_last_game"
         )
+        df["days_since_last_game_home"] = home_values
+        df["days_since_last_game_away"] = away_values
 
-        # Drop the unnecessary 'team' columns
-        df.drop(columns=["team_home", "team_away"], inplace=True)
         df["rest_diff_hv"] = (
             df["days_since_last_game_home"] - df["days_since_last_game_away"]
         )
         return df
 
-    def _calculate_team_performance_metrics(self, inbound_df):
-        df = inbound_df.copy()
-        df.sort_values(["season", "game_datetime"], inplace=True)
-
-        # initializing new columns
-        metrics_columns = [
-            "home_team_last_5_games_result",
-            "away_team_last_5_games_result",
-            "home_team_streak",
-            "away_team_streak",
-            "home_team_win_pct",
-            "away_team_win_pct",
-            "home_team_avg_point_diff",
-            "away_team_avg_point_diff",
-            "home_team_avg_point_diff_last_5",
-            "away_team_avg_point_diff_last_5",
-        ]
-        for col in metrics_columns:
-            df[col] = np.nan
-
-        # Loop through each season
-        # Metrics reset at the beginning of each season
-        # print(df.info(verbose=True, max_cols=1000, show_counts=True))
-        for season in df["season"].unique():
-            season_df = df.loc[df["season"] == season].copy()
-
-            # Loop through each team
-            # Metrics are calculated for each team
-            for team in pd.concat(
-                [season_df["home_team"], season_df["away_team"]]
-            ).unique():
-                mask = (season_df["home_team"] == team) | (
-                    season_df["away_team"] == team
-                )
-                team_df = season_df[mask].copy()
-                team_df["team"] = team
-
-                # Calculate the win/loss performance of the team in each game
-                conditions = [
-                    (~team_df["game_completed"]),
-                    (
-                        (team_df["home_team"] == team)
-                        & (team_df["home_score"] > team_df["away_score"])
-                    ),
-                    (
-                        (team_df["away_team"] == team)
-                        & (team_df["away_score"] > team_df["home_score"])
-                    ),
-                    (
-                        (team_df["home_team"] == team)
-                        & (team_df["home_score"] < team_df["away_score"])
-                    ),
-                    (
-                        (team_df["away_team"] == team)
-                        & (team_df["away_score"] < team_df["home_score"])
-                    ),
-                ]
-
-                choices = [0, 1, 1, -1, -1]
-
-                team_df["performance"] = np.select(conditions, choices, default=np.nan)
-
-                # Calculate the results of the last 5 games (excluding current game),
-                # with a value even if there are fewer than 5 previous games.
-                # Fill NaN with 0 for no prior games.
-                team_df["last_5_games_result"] = (
-                    team_df["performance"]
-                    .rolling(window=5, min_periods=1)
-                    .sum()
-                    .shift(1)
-                    .fillna(0)
-                )
-
-                # Initialize an empty list to store the streaks
-                streaks = []
-
-                # Initialize streak for the team
-                current_streak = 0
-
-                # Loop through each game for the team
-                for i, row in team_df.iterrows():
-                    # Append the current streak to the list
-                    streaks.append(current_streak)
-
-                    # Update the streak based on the game outcome
-                    performance = row["performance"]
-
-                    if (
-                        performance == 0
-                    ):  # If game is in progress, skip updating the streak
-                        continue
-
-                    if current_streak == 0:
-                        current_streak = performance
-                    elif np.sign(current_streak) == np.sign(performance):
-                        current_streak += performance
-                    else:
-                        current_streak = performance
-
-                # Add the calculated streaks to the DataFrame
-                team_df["streak"] = streaks
-
-                # Calculate win percentage (excluding current game)
-                team_df["win_pct"] = team_df["performance"].expanding().mean().shift(1)
-
-                # Calculate point differential
-                team_df["point_diff"] = np.where(
-                    team_df["home_team"] == team,
-                    team_df["home_score"] - team_df["away_score"],
-                    team_df["away_score"] - team_df["home_score"],
-                )
+    def _calculate_team_performance_metrics(self, df, team_games_df):
+        # Calculate the win/loss performance of the team in each game
+        # 1 for a win, -1 for a loss and 0 for games that are not completed
+        # Scores load as object dtype holding None when no loaded game has finished
+        team_score = team_games_df["team_score"].to_numpy(dtype=float, na_value=np.nan)
+        opponent_score = team_games_df["opponent_score"].to_numpy(
+            dtype=float, na_value=np.nan
+        )
+        result = (team_score > opponent_score).astype(np.int8) - (
+            team_score < opponent_score
+        ).astype(np.int8)
+        team_games_df["performance"] = np.where(
+            team_games_df["game_completed"].to_numpy(dtype=bool), result, np.int8(0)
+        )
 
-                # Compute the average point differential over all games (excluding current game)
-                team_df["avg_point_diff"] = (
-                    team_df["point_diff"].expanding().mean().shift(1).fillna(0)
-                )
+        # Calculate point differential
+        team_games_df["point_diff"] = team_score - opponent_score
 
-                # Compute the average point differential over the last 5 games (excluding current game)
-                team_df["avg_point_diff_last_5"] = (
-                    team_df["point_diff"].rolling(window=5).mean().shift(1).fillna(0)
-                )
+        # Metrics reset at the beginning of each season
+        team_groups = team_games_df.groupby(
+            ["season", "team"], sort=False, observed=True
+        )
 
-                # Update the main dataframe with the calculated metrics
-                update_cols = [
-                    "last_5_games_result",
-                    "streak",
-                    "win_pct",
-                    "avg_point_diff",
-                    "avg_point_diff_last_5",
-                ]
+        # Shift each team's results by one game so the metrics exclude the current game
+        team_games_df["prior_performance"] = team_groups["performance"].shift(1)
+        team_games_df["prior_point_diff"] = team_groups["point_diff"].shift(1)
+        prior_groups = team_games_df.groupby(
+            ["season", "team"], sort=False, observed=True
+        )
 
-                for col in update_cols:
-                    # For home team
-                    home_mask = (df["home_team"] == team) & mask
-                    df.loc[home_mask, f"home_team_{col}"] = team_df.loc[home_mask, col]
+        # Calculate the results of the last 5 games (excluding current game),
+        # with a value even if there are fewer than 5 previous games.
+        # Fill NaN with 0 for no prior games.
+        team_games_df["last_5_games_result"] = self._ungroup(
+            prior_groups["prior_performance"].rolling(window=5, min_periods=1).sum()
+        ).fillna(0)
+
+        # Streak going into each game for the team
+        # Rows are sorted by group, so each group is a contiguous block of rows
+        group_ids = team_groups.ngroup().to_numpy()
+        group_starts = np.r_[0, np.flatnonzero(np.diff(group_ids)) + 1, len(group_ids)]
+        streaks = np.empty(len(team_games_df))
+        _running_streaks(team_games_df["performance"].to_numpy(), group_starts, streaks)
+        team_games_df["streak"] = streaks
+
+        # Calculate win percentage (excluding current game)
+        team_games_df["win_pct"] = self._ungroup(
+            prior_groups["prior_performance"].expanding().mean()
+        )
 
-                    # For away team
-                    away_mask = (df["away_team"] == team) & mask
-                    df.loc[away_mask, f"away_team_{col}"] = team_df.loc[away_mask, col]
+        # Compute the average point differential over all games (excluding current game)
+        team_games_df["avg_point_diff"] = self._ungroup(
+            prior_groups["prior_point_diff"].expanding().mean()
+        ).fillna(0)
+
+        # Compute the average point differential over the last 5 games (excluding current game)
+        team_games_df["avg_point_diff_last_5"] = self._ungroup(
+            prior_groups["prior_point_diff"].rolling(window=5).mean()
+        ).fillna(0)
+
+        # Update the main dataframe with the calculated metrics
+        update_cols = [
+            "last_5_games_result",
+            "streak",
+            "win_pct",
+            "avg_point_diff",
+            "avg_point_diff_last_5",
+        ]
+        for col in update_cols:
+            home_values, away_values = self._split_home_and_away(team_games_df, col)
+            df[f"home_team_{col}"] = home_values
+            df[f"away_team_{col}"] = away_values
 
         # Compute the "home view" metrics
         df["last_5_hv"] = (
@@ -356,6 +327,24 @@ class FeatureCreationPostMerge:
 
         return df
 
+    @staticmethod
+    def _stack_home_and_away(df, home_col, away_col):
+        # Home team values followed by away team values as one array
+        return np.concatenate([df[home_col].to_numpy(), df[away_col].to_numpy()])
+
+    @staticmethod
+    def _split_home_and_away(team_games_df, col):
+        # Put the values back in game order, home team rows first then away team rows
+        values = np.empty(len(team_games_df))
+        values[team_games_df.index.to_numpy()] = team_games_df[col].to_numpy()
+        num_games = len(values) // 2
+        return values[:num_games], values[num_games:]
+
+    @staticmethod
+    def _ungroup(grouped_result):
+        # Drop the (season, team) levels added by a grouped rolling/expanding call
+        return grouped_result.reset_index(level=[0, 1], drop=True)
+
 
 if __name__ == "__main__":
     pass
@@ -234,50 +234,34 @@ class ETLPipeline:
             ).astype("str")
 
         for table_name, table in nbastats_team_dfs.items():
+            # Split the table by game set once instead of masking it for each team
+            game_set_dfs = dict(list(table.groupby("games", sort=False)))
             for team in ["home", "away"]:
                 for game_set in ["all", "l2w"]:
-                    sub_df = table.loc[table.games == game_set].copy()
+                    sub_df = game_set_dfs.get(game_set, table.iloc[:0]).drop(
+                        columns=["to_date", "games"]
+                    )
 
-                    # Rename columns to avoid duplicate column names
+                    # Rename the merge keys to match the game data and
+                    # rename the other columns to avoid duplicate column names
                     table_suffix = table_name.split("_")[-1]
-                    columns_to_not_rename = [
-                        "team_name",
-                        "to_date",
-                        "merge_date",
-                        "games",
-                    ]
+                    merge_keys = {
+                        "merge_date": "game_date",
+                        "team_name": f"{team}_team",
+                    }
                     sub_df.columns = [
-                        f"{col}_{team}_{game_set}_{table_suffix}"
-                        if col not in columns_to_not_rename
-                        else col
+                        merge_keys.get(col, f"{col}_{team}_{game_set}_{table_suffix}")
                         for col in sub_df.columns
                     ]
 
                     # Merge the sub_df to the combo_df
                     features_df = features_df.merge(
                         sub_df,
-                        left_on=["game_date", f"{team}_team"],
-                        right_on=["merge_date", "team_name"],
+                        on=["game_date", f"{team}_team"],
                         how="left",
-                        suffixes=("", f"_{table_name}_{team}_{game_set}"),
                         validate="1:1",
                     )
 
-                    # Drop the columns that were used for merging
-                    columns_to_drop = [
-                        "to_date",
-                        "merge_date",
-                        "team_name",
-                        "games",
-                    ]
-
-                    # Check and drop only the columns that exist in the DataFrame
-                    columns_to_drop = [
-                        col for col in columns_to_drop if col in features_df.columns
-                    ]
-                    # Now, safely drop the columns
-                    features_df = features_df.drop(columns=columns_to_drop)
-
         features_df = features_df.drop(columns=["game_date"])
 
         return features_df
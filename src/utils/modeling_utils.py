@@ -406,7 +406,11 @@ def calculate_roi(df, actual_column, pred_column, pred_prob=None):
             modified_groups.append(group_copy)
 
         # Concatenate all modified groups back together
-        df_modified = pd.concat(modified_groups, ignore_index=True)
+        # A single date needs no concat, its group is already the full result
+        if len(modified_groups) == 1:
+            df_modified = modified_groups[0]
+        else:
+            df_modified = pd.concat(modified_groups, ignore_index=True, copy=False)
 
         # Calculate average ROI using Kelly Criterion
         average_roi_even_kelly = round(total_roi_even_kelly / df_modified.shape[0], 2)